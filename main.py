@@ -1,8 +1,23 @@
 from flask import Flask, request, jsonify
 from gradio_client import Client, handle_file # Re-added handle_file to import
+from gradio_client.exceptions import AppError
+import atexit
+import functools
+import hashlib
+import httpx
+import ipaddress
+import logging
 import os
 import requests
-import uuid
+import shutil
+import socket
+import threading
+import time
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv # To load environment variables
 from supabase import create_client, Client as SupabaseClient
 
@@ -11,49 +26,541 @@ load_dotenv()
 
 app = Flask(__name__)
 
+# Lazy %s-style logging instead of print: formatting is skipped entirely when
+# the level is off, and workers no longer serialize on the stdout lock.
+logger = logging.getLogger(__name__)
+
 # --- Configuration for Temporary Image Storage ---
 UPLOAD_FOLDER = 'temp_images'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# --- Local cache for downloaded input images, keyed by SHA256 of the URL ---
+# Supabase image URLs are stable, so the same inputs recur across requests.
+CACHE_DIR = 'image_cache'
+os.makedirs(CACHE_DIR, exist_ok=True)
+CACHE_TTL_SECONDS = 3600
+# Entries (and their sidecar files) not touched for this long are evicted so
+# the cache directory doesn't grow by one file per unique URL forever.
+CACHE_EVICT_AFTER_SECONDS = 24 * 3600
+_cache_sweep_lock = threading.Lock()
+_last_cache_sweep = 0.0
+
+# handle_file accepts URLs directly, so publicly reachable inputs can be
+# fetched by the Space itself, skipping the local download + re-read
+# round-trip. Set PREFER_REMOTE_INPUTS=0 if the input URLs are private and
+# must be proxied through this server.
+PREFER_REMOTE_INPUTS = os.getenv("PREFER_REMOTE_INPUTS", "1") == "1"
+
+# --- Shared thread pool for network-bound work (downloads run concurrently) ---
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# --- Background cleanup of temporary files ---
+# Unlinking up to four files adds syscall latency to every response, so defer
+# the removals to a small worker pool instead of the request thread.
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+atexit.register(CLEANUP_EXECUTOR.shutdown)
+
+
+def _safe_unlink(path):
+    """Removes a file, ignoring the race where it is already gone."""
+    try:
+        os.remove(path)
+        logger.debug("Removed temporary file: %s", path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("Could not remove temporary file %s: %s", path, e)
+
+
+def schedule_cleanup(*paths):
+    """Queues temporary files for removal off the response critical path."""
+    for path in paths:
+        if path and os.path.exists(path):
+            CLEANUP_EXECUTOR.submit(_safe_unlink, path)
+
+# --- Shared HTTP session so repeat downloads reuse pooled keep-alive connections ---
+# Avoids a fresh TCP + TLS handshake on every image fetch.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
 # --- Supabase Configuration ---
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_BUCKET_NAME = os.getenv("SUPABASE_BUCKET_NAME", "virtual-try-extracted")
 
-# --- Debugging: Print loaded environment variables (first few chars for security) ---
-print(f"DEBUG: SUPABASE_URL (first 15 chars): {SUPABASE_URL[:15] if SUPABASE_URL else 'Not set'}")
-print(f"DEBUG: SUPABASE_KEY (first 10 chars): {SUPABASE_KEY[:10] if SUPABASE_KEY else 'Not set'}")
-print(f"DEBUG: SUPABASE_BUCKET_NAME: {SUPABASE_BUCKET_NAME}")
+# --- Debugging: Log loaded environment variables (first few chars for security) ---
+logger.debug("SUPABASE_URL (first 15 chars): %s", SUPABASE_URL[:15] if SUPABASE_URL else 'Not set')
+logger.debug("SUPABASE_KEY (first 10 chars): %s", SUPABASE_KEY[:10] if SUPABASE_KEY else 'Not set')
+logger.debug("SUPABASE_BUCKET_NAME: %s", SUPABASE_BUCKET_NAME)
 
 
 supabase: SupabaseClient = None
 if SUPABASE_URL and SUPABASE_KEY:
     try:
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        print("Supabase client initialized successfully.")
+        logger.info("Supabase client initialized successfully.")
     except Exception as e:
-        print(f"Error initializing Supabase client: {e}")
+        logger.error("Error initializing Supabase client: %s", e)
         supabase = None
 else:
-    print("Supabase URL or Key not found or empty in environment variables. Results will NOT be uploaded to Supabase.")
-    print("Please ensure SUPABASE_URL and SUPABASE_KEY are correctly set in your .env file and the file is in the same directory.")
+    logger.warning("Supabase URL or Key not found or empty in environment variables. Results will NOT be uploaded to Supabase.")
+    logger.warning("Please ensure SUPABASE_URL and SUPABASE_KEY are correctly set in your .env file and the file is in the same directory.")
+
+
+# --- Input URL validation (fail fast, before any expensive I/O) ---
+# Rejecting a malformed or over-limit request costs microseconds here versus
+# seconds of downloads and GPU inference later.
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_VALIDATION_REDIRECTS = 5
+HEAD_CACHE_TTL_SECONDS = 60
+_head_cache = {}
+_head_cache_lock = threading.Lock()
+
+
+def _resolves_to_private_address(host):
+    """True if the host resolves only to loopback/private/link-local addresses."""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return True
+    for info in infos:
+        addr = ipaddress.ip_address(info[4][0])
+        if not (addr.is_private or addr.is_loopback or addr.is_link_local or addr.is_reserved):
+            return False
+    return True
+
+
+def validate_image_url(url):
+    """Checks an input URL before any download; returns an error string or None.
+
+    Verifies the scheme, guards against SSRF targets, and HEADs the URL to
+    reject non-images and oversized files. HEAD results are cached briefly
+    since the same URLs recur across requests.
+    """
+    now = time.time()
+    with _head_cache_lock:
+        cached = _head_cache.get(url)
+        if cached and now - cached[0] < HEAD_CACHE_TTL_SECONDS:
+            return cached[1]
+
+    error = _check_image_url(url)
+
+    with _head_cache_lock:
+        _head_cache[url] = (now, error)
+    return error
+
+
+def _check_image_url(url):
+    """Validates a URL and every redirect hop it takes; see validate_image_url."""
+    target = url
+    for _ in range(MAX_VALIDATION_REDIRECTS + 1):
+        # Redirects are followed manually so each hop gets the same scheme and
+        # private-address checks as the original URL; following them blindly
+        # would let a public URL bounce the fetch to an internal host.
+        parsed = urlparse(target)
+        if parsed.scheme not in ('http', 'https'):
+            return f"URL scheme must be http or https, got '{parsed.scheme}'"
+        if not parsed.hostname:
+            return "URL has no hostname"
+        if _resolves_to_private_address(parsed.hostname):
+            return "URL host is not publicly resolvable"
+
+        try:
+            head = SESSION.head(target, timeout=(5, 10), allow_redirects=False)
+        except requests.exceptions.RequestException as e:
+            return f"URL is not reachable: {e}"
+
+        if head.is_redirect or head.is_permanent_redirect:
+            location = head.headers.get('Location')
+            if not location:
+                return f"URL returned status {head.status_code} without a Location header"
+            target = urljoin(target, location)
+            continue
+
+        # Some hosts don't implement HEAD; treat that as inconclusive rather
+        # than rejecting a URL the GET would serve fine.
+        if head.status_code in (405, 501):
+            return None
+        if not head.ok:
+            return f"URL returned status {head.status_code}"
+
+        content_length = head.headers.get('Content-Length')
+        if content_length:
+            try:
+                if int(content_length) > MAX_IMAGE_BYTES:
+                    return f"Image exceeds the {MAX_IMAGE_BYTES} byte limit"
+            except ValueError:
+                return "URL returned a malformed Content-Length header"
+        content_type = head.headers.get('Content-Type', '')
+        if content_type and not content_type.startswith('image/'):
+            return f"URL does not point to an image (Content-Type: {content_type})"
+        return None
+    return "URL redirects too many times"
+
+
+# --- Transient-failure handling for external calls ---
+# A one-off 429/5xx/timeout from the Space or Supabase otherwise surfaces as a
+# 500 and forces the caller to redo the expensive preceding steps.
+# gradio_client is built on httpx, whose timeout/connect/status errors
+# subclass neither requests.RequestException nor the builtins, so httpx.HTTPError
+# must be listed for the retry around client.predict to fire at all. AppError
+# is how the Space surfaces application errors, some of which are transient
+# (queue/GPU 429s and 5xx); _is_transient_error decides which ones retry.
+RETRYABLE_EXCEPTIONS = (
+    requests.exceptions.RequestException,
+    httpx.HTTPError,
+    AppError,
+    TimeoutError,
+    ConnectionError,
+)
+
+# AppError carries no status code, only the Space's message; retry only when
+# the message points at rate limiting or a server-side hiccup.
+_TRANSIENT_APP_ERROR_MARKERS = (
+    '429', '500', '502', '503', '504',
+    'rate limit', 'too many requests', 'timeout', 'temporarily',
+    'unavailable', 'overload', 'queue is full',
+)
+
+
+def _is_transient_error(e):
+    """True only for failures worth retrying: timeouts, dropped connections,
+    and 429/5xx responses. Deterministic rejections (bad input, bad key)
+    fail fast instead of burning attempts and backoff on a lost cause.
+    """
+    if isinstance(e, requests.exceptions.HTTPError):
+        response = e.response
+        return response is None or response.status_code == 429 or response.status_code >= 500
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    if isinstance(e, AppError):
+        message = str(e).lower()
+        return any(marker in message for marker in _TRANSIENT_APP_ERROR_MARKERS)
+    # Everything else in RETRYABLE_EXCEPTIONS is network-level (timeouts,
+    # connection resets) and always worth another attempt.
+    return True
+
+
+def retry_with_backoff(func, attempts=4, max_wait=20):
+    """Retries transient network failures with exponential backoff."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except RETRYABLE_EXCEPTIONS as e:
+                if attempt == attempts or not _is_transient_error(e):
+                    raise
+                wait = min(2 ** (attempt - 1), max_wait)
+                logger.warning("Transient error in %s (attempt %d/%d): %s. Retrying in %ds...",
+                               func.__name__, attempt, attempts, e, wait)
+                time.sleep(wait)
+    return wrapper
+
+
+class TokenBucket:
+    """Simple token-bucket limiter to stay under the Space's rate limit."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then consumes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Target at most one inference every 2 seconds in aggregate. The bucket is
+# per-process and the Procfile runs several gunicorn workers, so derate the
+# per-worker rate by the worker count (WEB_CONCURRENCY, defaulting to the
+# Procfile's -w 4); capacity 1 keeps the combined burst at one per worker.
+_WORKER_COUNT = max(1, int(os.getenv("WEB_CONCURRENCY", "4")))
+PREDICT_BUCKET = TokenBucket(rate=0.5 / _WORKER_COUNT, capacity=1)
+
+
+# --- Background finalization of try-on jobs ---
+# The two Supabase uploads don't need to block the response: the endpoint
+# returns a job id with 202 as soon as inference is done and a worker pool
+# finishes the uploads, which clients observe via the status endpoint.
+FINALIZE_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+atexit.register(FINALIZE_EXECUTOR.shutdown)
+
+JOBS = {}
+JOBS_LOCK = threading.Lock()
+JOB_TTL_SECONDS = 3600
+
+# gunicorn runs several worker processes, so a status poll rarely lands on the
+# worker that ran the job. Job state is therefore mirrored to a shared table
+# (same pattern as tryon_cache); the in-process dict stays as the fast path
+# and as a fallback when Supabase is not configured.
+TRYON_JOBS_TABLE = os.getenv("TRYON_JOBS_TABLE", "tryon_jobs")
+
+
+def _persist_job(job_id, fields):
+    """Mirrors job state to the shared table so any worker can answer polls."""
+    if not supabase:
+        return
+    try:
+        supabase.table(TRYON_JOBS_TABLE).upsert({"job_id": job_id, **fields}).execute()
+    except Exception as e:
+        logger.warning("Job store update failed for %s: %s", job_id, e)
+
+
+def _load_job(job_id):
+    """Fetches job state from the shared table; returns the row dict or None."""
+    if not supabase:
+        return None
+    try:
+        result = supabase.table(TRYON_JOBS_TABLE).select("status, output_url, masked_url, error").eq("job_id", job_id).limit(1).execute()
+        if result.data:
+            return result.data[0]
+    except Exception as e:
+        logger.warning("Job store lookup failed for %s: %s", job_id, e)
+    return None
+
+
+def _register_job(job_id):
+    """Creates a pending job entry and prunes expired ones."""
+    now = time.time()
+    with JOBS_LOCK:
+        for stale_id in [jid for jid, job in JOBS.items()
+                         if now - job["created_at"] > JOB_TTL_SECONDS]:
+            del JOBS[stale_id]
+        JOBS[job_id] = {"status": "processing", "created_at": now}
+    _persist_job(job_id, {"status": "processing"})
+
+
+def _finish_job(job_id, **fields):
+    with JOBS_LOCK:
+        JOBS[job_id].update(fields)
+    _persist_job(job_id, fields)
+
+
+def finalize_tryon(job_id, output_path, masked_path, cache_key):
+    """Uploads the Gradio outputs and publishes the job result.
+
+    Runs on the finalize pool after the endpoint has already responded;
+    owns (and cleans up) the two output files.
+    """
+    try:
+        processed_future = IO_EXECUTOR.submit(upload_to_supabase, output_path, "processed_images")
+        masked_future = IO_EXECUTOR.submit(upload_to_supabase, masked_path, "masked_images")
+        processed_image_public_url = processed_future.result()
+        masked_image_public_url = masked_future.result()
+
+        store_cached_tryon(cache_key, processed_image_public_url, masked_image_public_url)
+        _finish_job(job_id, status="done",
+                    output_url=processed_image_public_url,
+                    masked_url=masked_image_public_url)
+        logger.info("Job %s finalized: %s", job_id, processed_image_public_url)
+    except Exception as e:
+        logger.error("Error finalizing job %s: %s", job_id, e)
+        _finish_job(job_id, status="error", error=str(e))
+    finally:
+        schedule_cleanup(output_path, masked_path)
+
+
+# --- Gradio client singleton ---
+# Constructing Client(...) hits the Space's /config endpoint, so build it once
+# and reuse it across requests instead of paying that round-trip every call.
+GRADIO_SPACE = "jallenjia/Change-Clothes-AI"
+_gradio_client = None
+_gradio_lock = threading.Lock()
+
+
+def get_gradio_client():
+    """Returns the shared Gradio client, creating it on first use."""
+    global _gradio_client
+    if _gradio_client is None:
+        with _gradio_lock:
+            if _gradio_client is None:
+                _gradio_client = Client(GRADIO_SPACE)
+                logger.info("Gradio Client initialized. Loaded as API: %s", _gradio_client.src)
+    return _gradio_client
+
+
+# --- End-to-end result cache for /virtual-try-on ---
+# The Gradio inference is the dominant cost (tens of seconds of GPU time);
+# identical inputs with a pinned seed produce identical outputs, so cache the
+# resulting Supabase URLs in a table keyed by a hash of the inputs.
+TRYON_CACHE_TABLE = os.getenv("TRYON_CACHE_TABLE", "tryon_cache")
+
+
+def tryon_cache_key(human_image_url, garment_image_url, garment_description,
+                    denoise_steps, category, is_checked, is_checked_crop):
+    """Builds a deterministic cache key from the try-on inputs and parameters."""
+    raw = "|".join([
+        human_image_url,
+        garment_image_url,
+        garment_description,
+        str(denoise_steps),
+        category,
+        str(is_checked),
+        str(is_checked_crop),
+    ])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def get_cached_tryon(key):
+    """Looks up a previous try-on result; returns the row dict or None."""
+    if not supabase:
+        return None
+    try:
+        result = supabase.table(TRYON_CACHE_TABLE).select("output_url, masked_url").eq("key", key).limit(1).execute()
+        if result.data:
+            return result.data[0]
+    except Exception as e:
+        logger.warning("Tryon cache lookup failed (continuing without cache): %s", e)
+    return None
+
+
+def store_cached_tryon(key, output_url, masked_url):
+    """Records a try-on result so identical future requests skip inference."""
+    if not supabase:
+        return
+    try:
+        supabase.table(TRYON_CACHE_TABLE).upsert({
+            "key": key,
+            "output_url": output_url,
+            "masked_url": masked_url,
+        }).execute()
+    except Exception as e:
+        logger.warning("Tryon cache store failed (result still returned to client): %s", e)
+
+
+def _sweep_image_cache():
+    """Evicts cache entries unused for CACHE_EVICT_AFTER_SECONDS.
+
+    The directory scan runs at most once per TTL interval, so it stays off
+    nearly every request.
+    """
+    global _last_cache_sweep
+    now = time.time()
+    with _cache_sweep_lock:
+        if now - _last_cache_sweep < CACHE_TTL_SECONDS:
+            return
+        _last_cache_sweep = now
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > CACHE_EVICT_AFTER_SECONDS:
+                os.remove(path)
+                logger.debug("Evicted stale cache entry: %s", path)
+        except OSError:
+            pass
 
 
 def download_image(url, filename):
-    """Downloads an image from a URL and saves it locally."""
+    """Downloads an image from a URL and saves it locally.
+
+    Repeat URLs are served from a local content-addressed cache; stale
+    entries are revalidated with a conditional GET (If-None-Match), so an
+    unchanged image is never re-downloaded.
+    """
+    CLEANUP_EXECUTOR.submit(_sweep_image_cache)
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status() # Raise an exception for bad status codes
         filepath = os.path.join(UPLOAD_FOLDER, filename)
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"Downloaded {url} to {filepath}")
+        cache_path = os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+        etag_path = cache_path + '.etag'
+
+        # Fresh cache hit: skip the HTTP fetch entirely.
+        if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < CACHE_TTL_SECONDS:
+            shutil.copyfile(cache_path, filepath)
+            logger.debug("Cache hit for %s, reusing %s", url, cache_path)
+            return filepath
+
+        headers = {}
+        if os.path.exists(cache_path) and os.path.exists(etag_path):
+            with open(etag_path) as ef:
+                headers['If-None-Match'] = ef.read().strip()
+
+        response = SESSION.get(url, stream=True, timeout=(5, 30), headers=headers)
+        if response.status_code == 304:
+            # Unchanged on the server: refresh the TTL and reuse the cached bytes.
+            os.utime(cache_path, None)
+            shutil.copyfile(cache_path, filepath)
+            logger.debug("Cache revalidated (304) for %s, reusing %s", url, cache_path)
+            return filepath
+        response.raise_for_status() # Raise an exception for bad status codes
+
+        # Stream into a private temp file and move it into place only once the
+        # body is complete: a dropped connection can't leave a truncated entry
+        # behind (or clobber a good one), and concurrent fetches of the same
+        # URL don't interleave writes into cache_path.
+        tmp_path = f"{cache_path}.{secrets.token_hex(4)}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                # Copy in 1 MiB chunks inside C instead of an 8 KiB Python loop;
+                # decode_content keeps gzip/deflate bodies transparent like
+                # iter_content did.
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, f, length=1024 * 1024)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        etag = response.headers.get('ETag')
+        if etag:
+            with open(etag_path, 'w') as ef:
+                ef.write(etag)
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
+
+        shutil.copyfile(cache_path, filepath)
+        logger.debug("Downloaded %s to %s (cached at %s)", url, filepath, cache_path)
         return filepath
     except requests.exceptions.RequestException as e:
-        print(f"Error downloading image from {url}: {e}")
+        logger.error("Error downloading image from %s: %s", url, e)
         return None
 
+@retry_with_backoff
+def run_tryon(client, input_dict, garment_path, garment_description,
+              is_checked, is_checked_crop, denoise_steps, seed, category):
+    """Calls the Gradio /tryon API, rate-limited by the token bucket."""
+    PREDICT_BUCKET.acquire()
+    return client.predict(
+        dict=input_dict,
+        garm_img=handle_file(garment_path), # Re-added handle_file
+        garment_des=garment_description,
+        is_checked=is_checked,
+        is_checked_crop=is_checked_crop,
+        denoise_steps=denoise_steps,
+        seed=seed,
+        category=category,
+        api_name="/tryon"
+    )
+
+
+# Content types by file extension; Gradio often outputs .webp or .png, so
+# .webp is the fallback for unknown extensions.
+_CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
+
+
+@retry_with_backoff
 def upload_to_supabase(file_path, destination_folder="tryon_results"):
     """
     Uploads a local file to Supabase Storage and returns its public URL.
@@ -64,36 +571,42 @@ def upload_to_supabase(file_path, destination_folder="tryon_results"):
         raise FileNotFoundError(f"File not found for upload: {file_path}")
 
     filename = os.path.basename(file_path)
-    unique_filename = f"{uuid.uuid4()}_{filename}" # Ensure unique file names
+    unique_filename = f"{secrets.token_hex(8)}_{filename}" # Short random suffix keeps file names unique
     storage_path = f"{destination_folder}/{unique_filename}"
 
-    print(f"Attempting to upload {file_path} to Supabase at {SUPABASE_BUCKET_NAME}/{storage_path}...")
+    logger.debug("Attempting to upload %s to Supabase at %s/%s...", file_path, SUPABASE_BUCKET_NAME, storage_path)
 
     try:
         # Determine content type based on file extension
-        # Gradio often outputs .webp or .png
-        content_type = 'image/webp' # Default
-        if filename.lower().endswith('.png'):
-            content_type = 'image/png'
-        elif filename.lower().endswith('.jpeg') or filename.lower().endswith('.jpg'):
-            content_type = 'image/jpeg'
-        elif filename.lower().endswith('.gif'): # Add other common image types
-            content_type = 'image/gif'
-
+        content_type = _CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), 'image/webp')
 
         with open(file_path, 'rb') as f:
-            # The upload method typically returns a dict with 'path' and 'id' on success.
-            # It does NOT return a response object with status_code.
-            upload_result = supabase.storage.from_(SUPABASE_BUCKET_NAME).upload(storage_path, f.read(), {'content-type': content_type})
-            
-            # If the upload call completes without raising an exception, it was successful.
-            # Now, retrieve the public URL.
-            public_url = supabase.storage.from_(SUPABASE_BUCKET_NAME).get_public_url(storage_path)
-            print(f"Uploaded to Supabase successfully, public URL: {public_url}")
+            # POST the open file handle straight to the storage REST endpoint
+            # through the pooled SESSION: requests streams it from the file
+            # descriptor to the socket, so the image bytes never land in a
+            # Python-level buffer and connections/retries are shared with the
+            # download path.
+            upload_url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET_NAME}/{storage_path}"
+            upload_response = SESSION.post(
+                upload_url,
+                data=f,
+                headers={
+                    'Authorization': f'Bearer {SUPABASE_KEY}',
+                    'Content-Type': content_type,
+                    'x-upsert': 'true',
+                },
+                timeout=(5, 60),
+            )
+            upload_response.raise_for_status()
+
+            # The public URL format is deterministic, so build it locally
+            # instead of asking the client library after every upload.
+            public_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET_NAME}/{storage_path}"
+            logger.debug("Uploaded to Supabase successfully, public URL: %s", public_url)
             return public_url
 
     except Exception as e:
-        print(f"Error during Supabase upload: {e}")
+        logger.error("Error during Supabase upload: %s", e)
         # Re-raise the exception so the Flask endpoint catches it and returns a 500.
         raise
 
@@ -113,77 +626,131 @@ def virtual_try_on():
         if not human_image_url or not garment_image_url:
             return jsonify({"error": "Missing human_image_url or garment_image_url"}), 400
 
-        # 1. Download input images locally from the provided URLs for Gradio client
-        human_image_filename = f"human_input_{uuid.uuid4()}_{os.path.basename(human_image_url).split('?')[0]}"
-        garment_image_filename = f"garment_input_{uuid.uuid4()}_{os.path.basename(garment_image_url).split('?')[0]}"
+        # Reject obviously bad inputs before any download or inference work.
+        for field, url in (("human_image_url", human_image_url),
+                           ("garment_image_url", garment_image_url)):
+            validation_error = validate_image_url(url)
+            if validation_error:
+                return jsonify({"error": f"{field}: {validation_error}"}), 400
+
+        # Fixed inference parameters for the Gradio /tryon call.
+        denoise_steps = 30
+        category = "upper_body"
+        is_checked = True
+        is_checked_crop = False
+
+        # 0. Check the result cache: identical inputs with a pinned seed are
+        # deterministic, so a hit returns instantly with zero GPU cost.
+        cache_key = tryon_cache_key(human_image_url, garment_image_url, garment_description,
+                                    denoise_steps, category, is_checked, is_checked_crop)
+        cached = get_cached_tryon(cache_key)
+        if cached:
+            logger.debug("Tryon cache hit for key %s", cache_key)
+            return jsonify({
+                "output_url": cached["output_url"],
+                "masked_url": cached["masked_url"]
+            }), 200
+        # Pin the seed to the cache key so repeat runs are reproducible and
+        # the cached result stays valid. The Space's seed widget only accepts
+        # values up to 2**31 - 1, so clamp into that range.
+        seed = int(cache_key[:8], 16) % (2 ** 31)
+
+        # 1. Provide the input images to the Gradio client. Public HTTP(S)
+        # URLs are handed to handle_file directly so the Space fetches them
+        # itself; otherwise download them locally first.
+        if PREFER_REMOTE_INPUTS:
+            human_input = human_image_url
+            garment_input = garment_image_url
+        else:
+            human_image_filename = f"human_input_{secrets.token_hex(8)}_{os.path.basename(human_image_url).split('?')[0]}"
+            garment_image_filename = f"garment_input_{secrets.token_hex(8)}_{os.path.basename(garment_image_url).split('?')[0]}"
 
-        local_human_path = download_image(human_image_url, human_image_filename)
-        local_garment_path = download_image(garment_image_url, garment_image_filename)
+            # Both downloads are network-bound, so run them concurrently instead of
+            # back-to-back; total download time becomes max(t1, t2) instead of t1 + t2.
+            human_future = IO_EXECUTOR.submit(download_image, human_image_url, human_image_filename)
+            garment_future = IO_EXECUTOR.submit(download_image, garment_image_url, garment_image_filename)
+            local_human_path = human_future.result()
+            local_garment_path = garment_future.result()
 
-        if not local_human_path or not local_garment_path:
-            raise Exception("Failed to download one or more input images from provided URLs.")
+            if not local_human_path or not local_garment_path:
+                raise Exception("Failed to download one or more input images from provided URLs.")
+            human_input = local_human_path
+            garment_input = local_garment_path
 
-        # 2. Initialize the Gradio client and make the prediction
-        client = Client("jallenjia/Change-Clothes-AI")
-        print(f"Gradio Client initialized. Loaded as API: {client.src}")
+        # 2. Get the shared Gradio client and make the prediction
+        client = get_gradio_client()
 
         input_dict = {
-            "background": handle_file(local_human_path), # Re-added handle_file
+            "background": handle_file(human_input), # Re-added handle_file
             "layers": [],
             "composite": None
         }
 
-        print("Calling Gradio API /tryon...")
-        result = client.predict(
-            dict=input_dict,
-            garm_img=handle_file(local_garment_path), # Re-added handle_file
-            garment_des=garment_description,
-            is_checked=True,
-            is_checked_crop=False,
-            denoise_steps=30,
-            seed=-1,
-            category="upper_body",
-            api_name="/tryon"
-        )
-        print("Gradio API call complete.")
-        print(f"Raw Gradio result: {result}")
+        logger.debug("Calling Gradio API /tryon...")
+        result = run_tryon(client, input_dict, garment_input, garment_description,
+                           is_checked, is_checked_crop, denoise_steps, seed, category)
+        logger.debug("Gradio API call complete.")
+        logger.debug("Raw Gradio result: %s", result)
 
         if isinstance(result, tuple) and len(result) == 2:
             local_gradio_output_path = result[0]
             local_gradio_masked_path = result[1]
 
-            # 3. Upload these local Gradio output files to Supabase Storage
-            processed_image_public_url = upload_to_supabase(local_gradio_output_path, "processed_images")
-            masked_image_public_url = upload_to_supabase(local_gradio_masked_path, "masked_images")
-
-            print(f"Returning processed_image_public_url: {processed_image_public_url}")
-            print(f"Returning masked_image_public_url: {masked_image_public_url}")
-
+            # 3. Hand the Supabase uploads to the finalize pool and respond
+            # immediately; the client polls the status endpoint for the URLs.
+            job_id = secrets.token_hex(8)
+            _register_job(job_id)
+            FINALIZE_EXECUTOR.submit(finalize_tryon, job_id,
+                                     local_gradio_output_path, local_gradio_masked_path,
+                                     cache_key)
+            # The finalize job owns these files now; keep the finally block
+            # from deleting them mid-upload.
+            local_gradio_output_path = None
+            local_gradio_masked_path = None
+
+            logger.debug("Returning job_id: %s", job_id)
             return jsonify({
-                "output_url": processed_image_public_url,
-                "masked_url": masked_image_public_url
-            }), 200
+                "job_id": job_id,
+                "status": "processing",
+                "status_url": f"/virtual-try-on/status/{job_id}"
+            }), 202
         else:
             return jsonify({"error": "Unexpected API response format from Gradio API. Expected a tuple of 2 local file paths."}), 500
 
     except Exception as e:
-        print(f"Error in virtual try-on endpoint: {e}")
+        logger.error("Error in virtual try-on endpoint: %s", e)
         return jsonify({"error": str(e)}), 500
     finally:
-        # Clean up all temporary local files (inputs and outputs)
-        if local_human_path and os.path.exists(local_human_path):
-            print(f"Removing temporary file: {local_human_path}")
-            os.remove(local_human_path)
-        if local_garment_path and os.path.exists(local_garment_path):
-            print(f"Removing temporary file: {local_garment_path}")
-            os.remove(local_garment_path)
-        if local_gradio_output_path and os.path.exists(local_gradio_output_path):
-            print(f"Removing temporary file: {local_gradio_output_path}")
-            os.remove(local_gradio_output_path)
-        if local_gradio_masked_path and os.path.exists(local_gradio_masked_path):
-            print(f"Removing temporary file: {local_gradio_masked_path}")
-            os.remove(local_gradio_masked_path)
+        # Clean up all temporary local files (inputs and outputs) in the
+        # background so the response is not delayed by the unlinks.
+        schedule_cleanup(local_human_path, local_garment_path,
+                         local_gradio_output_path, local_gradio_masked_path)
+
+
+@app.route('/virtual-try-on/status/<job_id>', methods=['GET'])
+def virtual_try_on_status(job_id):
+    with JOBS_LOCK:
+        job = JOBS.get(job_id)
+    if job is None:
+        # The job may have run on another worker process; check the shared table.
+        job = _load_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job_id"}), 404
+    body = {"job_id": job_id, "status": job["status"]}
+    if job["status"] == "done":
+        body["output_url"] = job["output_url"]
+        body["masked_url"] = job["masked_url"]
+    elif job["status"] == "error":
+        body["error"] = job["error"]
+    return jsonify(body), 200
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # Local development entrypoint only; production runs under gunicorn with
+    # threaded workers (see Procfile) so concurrent requests don't serialize
+    # behind one long Gradio call.
+    app.run(host='0.0.0.0', port=5000, debug=False)